@@ -1,18 +1,22 @@
 #!/usr/bin/env python3
 
 import argparse
-import astral
 import asyncio
+import collections
 import datetime
+import functools
 import logging
+import math
 import pathlib
-import pytz
-import subprocess
+import signal
 import sys
 import threading
+import typing
 import zeroconf
+import zoneinfo
 
 
+import aiohttp
 import aiohue
 import aiohue.v2.models.device
 import aiohue.v2.models.device_power
@@ -22,12 +26,7 @@ import aiohue.v2.models.resource
 import aiohue.v2.models.temperature
 
 
-def find_device_owning_resource(resource, devices):
-    for device in devices:
-        if device.id == resource.owner.rid:
-            return device
-    return None
-
+log = logging.getLogger(__name__)
 
 parser = argparse.ArgumentParser(description="AIOHue Example")
 parser.add_argument("appkey", help="appkey for Hue bridge (filename or raw string)")
@@ -70,76 +69,82 @@ light_device_names = [ "Front porch light", 'Front walkway' ]
 motion_detected = False
 light_level = 0
 
-# Handle to a coroutine that will run when motion has been absent for
-# too long.
+# Task that waits out the motion timeout after the end of motion.  It
+# runs handle_state() if motion has been absent for too long.
 motion_timeout_handle = None
 
 # Seconds after the last detected "end-of-motion" event to consider the
 # motion over.
 motion_timeout_delay = 5 * 60
 
-tz = pytz.timezone("US/Mountain")
+tz = zoneinfo.ZoneInfo("America/Denver")
+
 
-my_astral = astral.Astral()
-my_location = my_astral['Denver']
+class LightState(typing.NamedTuple):
+    on: bool
+    color_xy: tuple[float, float] | None
+    brightness: int | None
+    light_temp: int | None
 
-light_off_state = {
+
+light_off_state = LightState(
     # Light's completely off.
-    'on': False,
-    'color_xy': None,
-    'brightness': None,
-    'light_temp': None
-}
+    on = False,
+    color_xy = None,
+    brightness = None,
+    light_temp = None
+)
 
-night_light_state = {
+night_light_state = LightState(
     # Dim light, reddish-yellow color, warm color temp.
-    'on': True,
-    'color_xy': [ 0.5, 0.45 ],
-    'brightness': 75,
-    'light_temp': 500
-}
+    on = True,
+    color_xy = (0.5, 0.45),
+    brightness = 75,
+    light_temp = 500
+)
 
-bright_light_state = {
+bright_light_state = LightState(
     # Bright light, neutral color, cold color temp.
     # This is used for motion at night.
-    'on': True,
-    'color_xy': [ 0.35, 0.4 ],
-    'brightness': 100,
-    'light_temp': 153
-}
+    on = True,
+    color_xy = (0.35, 0.4),
+    brightness = 100,
+    light_temp = 153
+)
 
-daytime_motion_light_state = {
+daytime_motion_light_state = LightState(
     # This is used for motion during the day.
-    'on': False,
-    'color_xy': [ 0.7, 0.25 ],
-    'brightness': 50,
-    'light_temp': 153
-}
+    on = False,
+    color_xy = (0.7, 0.25),
+    brightness = 50,
+    light_temp = 153
+)
 
 default_light_state = light_off_state
 
+# The LightState most recently sent to the lights successfully, or None.
+last_applied_state = None
+
 
-def notify(msg: str):
-    print(f"notifying: {msg}")
+async def notify(msg: str):
+    log.info("notifying: %s", msg)
 
     cmd = ['/home/seb/send-text', msg]
-    try:
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            check=True
-        )
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    stdout, stderr = await proc.communicate()
 
-    except subprocess.CalledProcessError as e:
-        print(f"failed to run program:")
-        print(f"    cmd: {cmd}")
-        print(f"    returncode: {e.returncode}")
-        print(f"    stdout: {e.stdout}")
-        print(f"    stderr: {e.stderr}")
-        raise e
+    if proc.returncode != 0:
+        log.error("failed to run program:")
+        log.error("    cmd: %s", cmd)
+        log.error("    returncode: %s", proc.returncode)
+        log.error("    stdout: %s", stdout.decode())
+        log.error("    stderr: %s", stderr.decode())
 
-    return result
+    return proc.returncode
 
 
 def make_timedelta_str(d: datetime.timedelta):
@@ -147,105 +152,148 @@ def make_timedelta_str(d: datetime.timedelta):
 
 
 def make_seconds_str(seconds: float):
-    timedelta_str = ""
-
-    seconds_per_minute = 60
-    seconds_per_hour = 60 * seconds_per_minute
-    seconds_per_day = 24 * seconds_per_hour
-
-    if seconds > seconds_per_day:
-        days = int(seconds / seconds_per_day)
-        timedelta_str += f"{days} days "
-        seconds -= days * seconds_per_day
-
-    hours = int(seconds / seconds_per_hour)
-    seconds -= hours * seconds_per_hour
-
-    minutes = int(seconds / seconds_per_minute)
-    seconds -= minutes * seconds_per_minute
-
-    seconds = int(seconds)
-
-    timedelta_str += f"{hours:02d}:{minutes:02d}:{seconds:02d}"
-
-    return timedelta_str
-
-
-def get_sun_up(tomorrow=False):
-    global my_location
-    global tz
-
-    degrees_above_horizon = 4
+    days, seconds = divmod(int(seconds), 24 * 60 * 60)
+    hours, seconds = divmod(seconds, 60 * 60)
+    minutes, seconds = divmod(seconds, 60)
+    return (f"{days} days " if days else "") + f"{hours:02d}:{minutes:02d}:{seconds:02d}"
+
+
+@functools.lru_cache(maxsize=8)
+def _sunrise_sunset(date: datetime.date, lat=39.74, lon=-104.99, degrees_above_horizon=4):
+    # Closed-form sunrise/sunset: solar declination and the equation of
+    # time from the day of the year, then the hour angle at which the sun
+    # is `degrees_above_horizon` up.  Good to a minute or two, which is
+    # plenty for a porch light.  Cached, since the answer doesn't change
+    # during the day.
+    day_of_year = date.timetuple().tm_yday
+
+    # Days since the December solstice.
+    d = day_of_year + 10
+    psi = math.radians(d / 365 * 360)
+    declination = -math.asin(math.sin(math.radians(23.44)) * math.cos(psi))
+
+    # Equation of time, in hours.
+    b = math.radians((day_of_year - 81) / 365 * 360)
+    eot = (9.87 * math.sin(2 * b) - 7.53 * math.cos(b) - 1.5 * math.sin(b)) / 60
+
+    # Solar noon, in hours after midnight UTC.
+    ct0 = 12 - lon / 15 - eot
+
+    lat = math.radians(lat)
+    cos_sigma = (
+        (math.sin(math.radians(degrees_above_horizon)) - math.sin(lat) * math.sin(declination))
+        / (math.cos(lat) * math.cos(declination))
+    )
+    sigma = math.degrees(math.acos(cos_sigma))
+
+    midnight = datetime.datetime(date.year, date.month, date.day, tzinfo=datetime.timezone.utc)
+    sun_up = midnight + datetime.timedelta(hours=ct0 - sigma / 15)
+    sun_down = midnight + datetime.timedelta(hours=ct0 + sigma / 15)
+    # Leave these in UTC: subtracting two datetimes that share a ZoneInfo
+    # ignores their UTC offsets, which gets durations wrong across DST
+    # changes.  Convert to local time only for display.
+    return sun_up, sun_down
+
+
+def get_sun_up(tomorrow=False, now=None):
+    if now is None:
+        now = datetime.datetime.now(tz)
+    date = now.date()
     if tomorrow:
-        tomorrow = datetime.datetime.now(tz) + datetime.timedelta(days=1)
-        sun_up = my_location.time_at_elevation(degrees_above_horizon, astral.SUN_RISING, date=tomorrow)
-    else:
-        sun_up = my_location.time_at_elevation(degrees_above_horizon, astral.SUN_RISING)
-    return sun_up
+        date += datetime.timedelta(days=1)
+    return _sunrise_sunset(date)[0]
 
 
-def get_sun_down():
-    global my_location
-    degrees_above_horizon = 4
-    sun_down = my_location.time_at_elevation(degrees_above_horizon, astral.SUN_SETTING)
-    return sun_down
+def get_sun_down(now=None):
+    if now is None:
+        now = datetime.datetime.now(tz)
+    return _sunrise_sunset(now.date())[1]
 
 
-def is_daytime():
-    global tz
-    if get_sun_up() < datetime.datetime.now(tz) < get_sun_down():
+def is_daytime(now=None):
+    if now is None:
+        now = datetime.datetime.now(tz)
+    if get_sun_up(now=now) < now < get_sun_down(now=now):
         return True
     return False
 
 
 async def main():
     """Run Main execution."""
-    if args.debug:
-        logging.basicConfig(
-            level=logging.DEBUG,
-            format="%(asctime)-15s %(levelname)-5s %(name)s -- %(message)s",
-        )
+    global motion_timeout_handle
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO,
+        format="%(asctime)-15s %(levelname)-5s %(name)s -- %(message)s",
+    )
 
     async with aiohue.HueBridgeV2(hue_ipaddr, args.appkey) as bridge:
         global motion_detected
         global light_level
 
+        # Held while handle_state() talks to the bridge, so only one light
+        # update is in flight at a time and last_applied_state matches
+        # what the bridge applied last.
         bridge_lock = asyncio.Lock()
 
-        print("Motion sensors:")
+        # Set when motion starts, to wake up a pending motion timeout.
+        motion_resumed = asyncio.Event()
+
+        # Running notify() tasks, referenced here so they don't get garbage
+        # collected before they finish.
+        notify_tasks = set()
+
+        def notify_done(task):
+            notify_tasks.discard(task)
+            if task.cancelled():
+                return
+            e = task.exception()
+            if e is not None:
+                log.error("failed to send notification:", exc_info=e)
+
+        # Index the devices in one pass: by the types of resources they
+        # provide, and by name.
+        devices_by_rtype = collections.defaultdict(list)
+        name_to_device = {}
+        duplicate_names = set()
         for device in bridge.devices:
-            if aiohue.v2.models.resource.ResourceTypes.MOTION in [x.rtype for x in device.services]:
-                print(f"    {device.metadata.name} ({device.id})")
+            for rtype in {x.rtype for x in device.services}:
+                devices_by_rtype[rtype].append(device)
+            if device.metadata.name in name_to_device:
+                duplicate_names.add(device.metadata.name)
+            name_to_device[device.metadata.name] = device
 
-        print("Lights:")
-        for device in bridge.devices:
-            if aiohue.v2.models.resource.ResourceTypes.LIGHT in [x.rtype for x in device.services]:
-                print(f"    {device.metadata.name} ({device.id})")
+        # The devices are found by name, so the names must be unique.
+        for name in [motion_sensor_device_name, *light_device_names]:
+            if name in duplicate_names:
+                raise SystemExit(f"more than one device named '{name}'")
 
-        print()
+        log.info("Motion sensors:")
+        for device in devices_by_rtype[aiohue.v2.models.resource.ResourceTypes.MOTION]:
+            log.info("    %s (%s)", device.metadata.name, device.id)
+
+        log.info("Lights:")
+        for device in devices_by_rtype[aiohue.v2.models.resource.ResourceTypes.LIGHT]:
+            log.info("    %s (%s)", device.metadata.name, device.id)
 
         # Find the devices:
         #     Outdoor Motion Sensor
         #     Light
-        motion_device = None
-        light_devices = []
-        for device in bridge.devices:
-            if device.metadata.name == motion_sensor_device_name:
-                motion_device = device
-                print(f"found motion device '{motion_device.metadata.name}' ({motion_device.id})")
-                for service in motion_device.services:
-                    print(f"    {service.rtype} ({service.rid})")
-
-            elif device.metadata.name in light_device_names:
-                light_devices.append(device)
-                print(f"found light device '{device.metadata.name}' ({device.id})")
-                for service in device.services:
-                    print(f"    {service.rtype} ({service.rid})")
+        motion_device = name_to_device.get(motion_sensor_device_name)
+        if motion_device is not None:
+            log.info("found motion device '%s' (%s)", motion_device.metadata.name, motion_device.id)
+            for service in motion_device.services:
+                log.info("    %s (%s)", service.rtype, service.rid)
 
-            else:
-                #print()
-                #print(f"device: {device}")
-                pass
+        light_devices = []
+        for name in light_device_names:
+            device = name_to_device.get(name)
+            if device is None:
+                continue
+            light_devices.append(device)
+            log.info("found light device '%s' (%s)", device.metadata.name, device.id)
+            for service in device.services:
+                log.info("    %s (%s)", service.rtype, service.rid)
 
         if motion_device is None:
             raise SystemExit("motion sensor device not found")
@@ -262,28 +310,53 @@ async def main():
             if type(sensor) is aiohue.v2.models.motion.Motion and sensor.owner.rid == motion_device.id:
                 motion_sensor = sensor
                 motion_detected = motion_sensor.motion.motion
-                print(f"found motion sensor: valid={motion_sensor.motion.motion_valid}, motion={motion_sensor.motion.motion}")
+                log.info("found motion sensor: valid=%s, motion=%s", motion_sensor.motion.motion_valid, motion_sensor.motion.motion)
             elif type(sensor) is aiohue.v2.models.temperature.Temperature and sensor.owner.rid == motion_device.id:
                 temperature_sensor = sensor
-                print(f"found temperature sensor: valid={temperature_sensor.temperature.temperature_valid}, temperature={temperature_sensor.temperature.temperature} °C")
+                log.info("found temperature sensor: valid=%s, temperature=%s °C", temperature_sensor.temperature.temperature_valid, temperature_sensor.temperature.temperature)
             elif type(sensor) is aiohue.v2.models.light_level.LightLevel and sensor.owner.rid == motion_device.id:
                 light_level_sensor = sensor
                 light_level = light_level_sensor.light.light_level
-                print(f"found light_level sensor: valid={light_level_sensor.light.light_level_valid} light_level={light_level_sensor.light.light_level}")
+                log.info("found light_level sensor: valid=%s light_level=%s", light_level_sensor.light.light_level_valid, light_level_sensor.light.light_level)
             elif type(sensor) is aiohue.v2.models.device_power.DevicePower and sensor.owner.rid == motion_device.id:
                 device_power_sensor = sensor
-                print(f"found device_power sensor: battery_level={device_power_sensor.power_state.battery_level}%")
+                log.info("found device_power sensor: battery_level=%s%%", device_power_sensor.power_state.battery_level)
         if None in [motion_sensor, device_power_sensor, light_level_sensor, temperature_sensor]:
             raise SystemExit("expected sensor not found")
 
         # Find the light resources corresponding to the selected light devices.
+        light_device_by_id = {device.id: device for device in light_devices}
         lights = []
         for light in bridge.lights:
-            if light.owner.rid in [ x.id for x in light_devices]:
+            if light.owner.rid in light_device_by_id:
                 lights.append(light)
                 #print(f"found light: on={light.on.on}")
         if len(lights) != len(light_devices):
             raise SystemExit("light(s) missing")
+        light_to_device = {light.id: light_device_by_id[light.owner.rid] for light in lights}
+
+        # The zigbee_connectivity services of the light devices.  These
+        # update when a light becomes unreachable or comes back, e.g.
+        # after being power-cycled at the wall.
+        light_connectivity_ids = {
+            service.rid
+            for device in light_devices
+            for service in device.services
+            if service.rtype == aiohue.v2.models.resource.ResourceTypes.ZIGBEE_CONNECTIVITY
+        }
+
+        # Find a room or zone holding exactly these lights, so they can all
+        # be set with a single grouped_light request instead of one request
+        # per light.
+        grouped_light_id = None
+        light_ids = {light.id for light in lights}
+        for grouped_light in bridge.groups.grouped_light:
+            if {x.id for x in bridge.groups.grouped_light.get_lights(grouped_light.id)} == light_ids:
+                grouped_light_id = grouped_light.id
+                log.info("found grouped_light for the lights (%s)", grouped_light_id)
+                break
+        if grouped_light_id is None:
+            log.info("no room or zone with just these lights, setting them one at a time")
 
 
 #        async def motion_detected_flash(porch_light):
@@ -325,9 +398,12 @@ async def main():
             global motion_timeout_handle
             global light_level
             global default_light_state
+            global last_applied_state
             global tz
 
-            print(f"handling state: light_level={light_level}, motion_detected={motion_detected}, motion_timeout_handle={motion_timeout_handle}")
+            now = datetime.datetime.now(tz)
+
+            log.debug("handling state: light_level=%s, motion_detected=%s, motion_timeout_handle=%s", light_level, motion_detected, motion_timeout_handle)
 
             if motion_detected and not motion_timeout_handle:
                 #notify("new motion on the front porch!")
@@ -340,102 +416,213 @@ async def main():
             if motion_detected or motion_timeout_handle:
                 # There's motion on the porch, currently or recently...
 
-                if is_daytime():
+                if is_daytime(now=now):
                     # ... but it's bright out, no need for more light.
                     porch_light_state = daytime_motion_light_state
-                    print("motion on the porch, but daytime")
+                    log.debug("motion on the porch, but daytime")
 
                 else:
                     # ... and it's dark, let's turn on the porch light.
                     porch_light_state = bright_light_state
-                    print("motion on the porch, in the dark: light on bright")
+                    log.debug("motion on the porch, in the dark: light on bright")
 
             else:
                 # No motion, default light state is set by the Sun handler.
                 porch_light_state = default_light_state
-                print("no motion on the porch, reverting to sun-controlled light state")
+                log.debug("no motion on the porch, reverting to sun-controlled light state")
 
-            print(f"setting front-yard lights: on={porch_light_state['on']}, brightness={porch_light_state['brightness']}, color_xy={porch_light_state['color_xy']}, color_temp={porch_light_state['light_temp']}")
+            if porch_light_state is last_applied_state:
+                log.debug("front-yard lights are already in this state")
+                return
 
-            for light in lights:
-                light_device = find_device_owning_resource(light, light_devices)
-                if light_device is None:
-                    print(f"    light device for light resource {light.id} not found!")
-                    next
-                print(f"    {light_device.metadata.name}")
+            log.info("setting front-yard lights: on=%s, brightness=%s, color_xy=%s, color_temp=%s", porch_light_state.on, porch_light_state.brightness, porch_light_state.color_xy, porch_light_state.light_temp)
+
+            if grouped_light_id is not None:
                 try:
-                    await bridge.lights.set_state(
+                    await bridge.groups.grouped_light.set_state(
+                        id = grouped_light_id,
+                        on = porch_light_state.on,
+                        brightness = porch_light_state.brightness,
+                        color_xy = porch_light_state.color_xy,
+                        color_temp = porch_light_state.light_temp,
+                        transition_time = 1000
+                    )
+                    last_applied_state = porch_light_state
+                    return
+                except (aiohue.errors.AiohueException, aiohttp.ClientError) as e:
+                    log.warning("failed to control grouped light, falling back to individual lights:")
+                    log.warning("%s", e)
+
+            for light in lights:
+                log.debug("    %s", light_to_device[light.id].metadata.name)
+
+            # Send all the requests at once so their round trips overlap.
+            results = await asyncio.gather(
+                *[
+                    bridge.lights.set_state(
                         id = light.id,
-                        on = porch_light_state['on'],
-                        brightness = porch_light_state['brightness'],
-                        color_xy = porch_light_state['color_xy'],
-                        color_temp = porch_light_state['light_temp'],
+                        on = porch_light_state.on,
+                        brightness = porch_light_state.brightness,
+                        color_xy = porch_light_state.color_xy,
+                        color_temp = porch_light_state.light_temp,
                         transition_time = 1000
                     )
-                except aiohue.errors.AiohueException as e:
-                    print(f"failed to control light '{light_device.metadata.name}':")
-                    print(e)
-                    print("is power to the light off?")
+                    for light in lights
+                ],
+                return_exceptions=True
+            )
+
+            failed = False
+            for light, result in zip(lights, results):
+                if isinstance(result, (aiohue.errors.AiohueException, aiohttp.ClientError)):
+                    failed = True
+                    log.warning("failed to control light '%s':", light_to_device[light.id].metadata.name)
+                    log.warning("%s", result)
+                    log.warning("is power to the light off?")
+                elif isinstance(result, BaseException):
+                    raise result
+            if not failed:
+                last_applied_state = porch_light_state
 
 
         async def handle_motion_timeout():
             global motion_timeout_handle
 
-            await asyncio.sleep(motion_timeout_delay)
-            now = datetime.datetime.now()
-            print()
-            print(datetime.datetime.isoformat(now, ' ', 'seconds'))
-            print(f"motion timeout: it's been {make_seconds_str(motion_timeout_delay)} since the end of motion")
+            try:
+                await asyncio.wait_for(motion_resumed.wait(), motion_timeout_delay)
+            except asyncio.TimeoutError:
+                pass
+            else:
+                # Motion came back before the timeout, the next end of
+                # motion will start a new one.
+                if motion_timeout_handle is asyncio.current_task():
+                    motion_timeout_handle = None
+                return
+
+            if motion_timeout_handle is not asyncio.current_task():
+                # A newer motion timeout replaced this one, leave it to
+                # that one.
+                return
+
+            log.info("motion timeout: it's been %s since the end of motion", make_seconds_str(motion_timeout_delay))
             motion_timeout_handle = None
-            await handle_state()
+            async with bridge_lock:
+                await handle_state()
 
 
-        async def handle_event(event_type, item):
+        # Handlers for update events from our sensors.  Each returns True
+        # if handle_state() should run, or False if there's nothing more
+        # to do.
+
+        def handle_motion(item):
             global motion_timeout_handle
             global motion_detected
+
+            prev_motion_detected = motion_detected
+            motion_detected = item.motion.motion_valid and item.motion.motion
+            if motion_detected and not prev_motion_detected:
+                # Motion started, wake up the pending motion timeout.
+                motion_resumed.set()
+            elif prev_motion_detected and not motion_detected:
+                # Motion just ended, start the motion timeout.
+                motion_resumed.clear()
+                motion_timeout_handle = asyncio.create_task(handle_motion_timeout())
+            log.info("motion: valid=%s, motion=%s", item.motion.motion_valid, item.motion.motion)
+            return True
+
+        def handle_light_level(item):
             global light_level
 
+#            print(f"light level: valid={item.light.light_level_valid} light_level={item.light.light_level}")
+            light_level = item.light.light_level
+            return False
+
+        def handle_device_power(item):
+            # Send the notification in the background, the lights
+            # shouldn't have to wait for it.
+            battery_level = item.power_state.battery_level
+            log.info("device power: battery_level=%s%%", battery_level)
+            notify_task = asyncio.create_task(notify(f"front porch motion sensor battery level is {battery_level}%"))
+            notify_tasks.add(notify_task)
+            notify_task.add_done_callback(notify_done)
+            return True
+
+#        def handle_temperature(item):
+#            print(f"temperature: valid={item.temperature.temperature_valid}, temperature={item.temperature.temperature} °C")
+#            return False
+
+        # Look up the handler by sensor id, one dict lookup per event.
+        event_handlers = {
+            motion_sensor.id: handle_motion,
+            light_level_sensor.id: handle_light_level,
+            device_power_sensor.id: handle_device_power,
+#            temperature_sensor.id: handle_temperature,
+        }
+
+
+        def light_matches_state(light, state):
+            if light.on.on != state.on:
+                return False
+            if state.on and state.brightness is not None and light.dimming is not None:
+                return abs(light.dimming.brightness - state.brightness) < 1
+            return True
+
+        async def handle_light_change(item):
+            # The lights can be changed behind our back (the Hue app, a
+            # wall switch, a power cycle).  Forget what we last sent so
+            # the next handle_state() sends it again, like it did before
+            # last_applied_state existed.  This runs under the lock so an
+            # in-flight handle_state() can't store its state after the
+            # reset, and so our own update's echo is compared against the
+            # state we just sent.
+            global last_applied_state
+
             async with bridge_lock:
-                if event_type is not aiohue.v2.EventType.RESOURCE_UPDATED:
-                    # unhandled event type
-                    #print(f"{event_type}: {item}")
+                if last_applied_state is None:
                     return
-
-                if type(item) is aiohue.v2.models.motion.Motion and item.id == motion_sensor.id:
-                    msg = f"motion: valid={item.motion.motion_valid}, motion={item.motion.motion}"
-                    motion_detected = item.motion.motion_valid and item.motion.motion
-                    if not motion_detected:
-                        if motion_timeout_handle is not None:
-                            motion_timeout_handle.cancel()
-                            motion_timeout_handle = None
-                        motion_timeout_handle = asyncio.create_task(handle_motion_timeout())
-
-#                elif type(item) is aiohue.v2.models.temperature.Temperature and item.id == temperature_sensor.id:
-#                    print(f"temperature: valid={item.temperature.temperature_valid}, temperature={item.temperature.temperature} °C")
-
-                elif type(item) is aiohue.v2.models.light_level.LightLevel and item.id == light_level_sensor.id:
-#                    print(f"light level: valid={item.light.light_level_valid} light_level={item.light.light_level}")
-                    light_level = item.light.light_level
+                if item.id in light_to_device and light_matches_state(item, last_applied_state):
                     return
+                log.debug("front-yard lights changed outside of this program")
+                last_applied_state = None
 
-                elif type(item) is aiohue.v2.models.device_power.DevicePower and item.id == device_power_sensor.id:
-                    msg = f"device power: battery_level={item.power_state.battery_level}%"
-                    notify(f"front porch motion sensor battery level is {item.power_state.battery_level}%")
-
-                else:
-                    # unhandled Resource Update event
-                    #if type(item) is aiohue.v2.models.light.Light and item.id == porch_light.id:
-                    #    print(f"light change:")
-                    #    print(f"    color_temp={item.color_temperature.mirek}")
-                    #    print(f"    color={item.color.xy}")
-                    #    print(f"    dimming={item.dimming}")
-                    return
 
-                now = datetime.datetime.now()
-                print()
-                print(datetime.datetime.isoformat(now, ' ', 'seconds'))
-                print(msg)
+        async def handle_event(event_type, item):
+            global last_applied_state
+
+            if event_type is aiohue.v2.EventType.RECONNECTED:
+                # The bridge or the lights may have changed while we were
+                # disconnected, forget what we last sent and send it again.
+                log.info("reconnected to bridge")
+                async with bridge_lock:
+                    last_applied_state = None
+                    await handle_state()
+                return
+
+            if event_type is not aiohue.v2.EventType.RESOURCE_UPDATED:
+                # unhandled event type
+                #print(f"{event_type}: {item}")
+                return
+
+            if item.id in light_to_device or item.id in light_connectivity_ids:
+                await handle_light_change(item)
+                return
+
+            # The handlers only update state variables and don't await, so
+            # they don't need the lock; only the bridge update does.
+            handler = event_handlers.get(item.id)
+            if handler is None:
+                # unhandled Resource Update event
+                #if type(item) is aiohue.v2.models.light.Light and item.id == porch_light.id:
+                #    print(f"light change:")
+                #    print(f"    color_temp={item.color_temperature.mirek}")
+                #    print(f"    color={item.color.xy}")
+                #    print(f"    dimming={item.dimming}")
+                return
+
+            if not handler(item):
+                return
 
+            async with bridge_lock:
                 await handle_state()
 
 
@@ -445,46 +632,72 @@ async def main():
             global night_light_state
             global tz
 
+            # Today's sun-up/sun-down and tomorrow's sun-up, recomputed
+            # only when the date changes.
+            cached_date = None
+            cached_sun_up = None
+            cached_sun_down = None
+            cached_tomorrow_sun_up = None
+
             while True:
                 now = datetime.datetime.now(tz)
-                sun_up = get_sun_up()
-                sun_down = get_sun_down()
-                print()
-                print(f"thinking about the sun")
-                print(f"    current time is {now.isoformat(' ', 'seconds')}")
-                print(f"    sun-up is at {sun_up.isoformat(' ', 'seconds')}")
-                print(f"    sun-down is at {sun_down.isoformat(' ', 'seconds')}")
+                if now.date() != cached_date:
+                    cached_date = now.date()
+                    cached_sun_up = get_sun_up(now=now)
+                    cached_sun_down = get_sun_down(now=now)
+                    cached_tomorrow_sun_up = get_sun_up(tomorrow=True, now=now)
+                sun_up = cached_sun_up
+                sun_down = cached_sun_down
+                log.info("thinking about the sun")
+                log.info("    current time is %s", now.isoformat(' ', 'seconds'))
+                log.info("    sun-up is at %s", sun_up.astimezone(tz).isoformat(' ', 'seconds'))
+                log.info("    sun-down is at %s", sun_down.astimezone(tz).isoformat(' ', 'seconds'))
 
                 if now < sun_up:
-                    print("    it's before sun-up, turning on night light")
+                    log.info("    it's before sun-up, turning on night light")
                     default_light_state = night_light_state
                     sleep_duration = sun_up - now
-                    print(f"    sleeping until sun-up ({sun_up.isoformat(' ', 'seconds')}, in {make_timedelta_str(sleep_duration)})")
+                    log.info("    sleeping until sun-up (%s, in %s)", sun_up.astimezone(tz).isoformat(' ', 'seconds'), make_timedelta_str(sleep_duration))
 
                 elif now < sun_down:
-                    print("    it's between sun-up and sun-down, turning off light")
+                    log.info("    it's between sun-up and sun-down, turning off light")
                     default_light_state = light_off_state
                     sleep_duration = sun_down - now
-                    print(f"    sleeping until sun-down ({sun_down.isoformat(' ', 'seconds')}, in {make_timedelta_str(sleep_duration)})")
+                    log.info("    sleeping until sun-down (%s, in %s)", sun_down.astimezone(tz).isoformat(' ', 'seconds'), make_timedelta_str(sleep_duration))
 
                 else:
-                    print("    it's after sun-down, turning on night light")
+                    log.info("    it's after sun-down, turning on night light")
                     default_light_state = night_light_state
-                    sun_up = get_sun_up(tomorrow=True)
+                    sun_up = cached_tomorrow_sun_up
                     sleep_duration = sun_up - now
-                    print(f"    sleeping until sun-up tomorrow ({sun_up.isoformat(' ', 'seconds')}, in {make_timedelta_str(sleep_duration)})")
+                    log.info("    sleeping until sun-up tomorrow (%s, in %s)", sun_up.astimezone(tz).isoformat(' ', 'seconds'), make_timedelta_str(sleep_duration))
 
-                await handle_state()
+                async with bridge_lock:
+                    await handle_state()
                 await asyncio.sleep(sleep_duration.total_seconds())
 
 
-        asyncio.create_task(handle_sun())
+        sun_task = asyncio.create_task(handle_sun())
         bridge.subscribe(handle_event)
-        while True:
-            await asyncio.sleep(3600)
+
+        # Set on SIGINT/SIGTERM, main() sleeps on this until it's time to
+        # exit.  Installed only now so a signal during bridge setup still
+        # interrupts it right away.
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGINT, stop_event.set)
+        loop.add_signal_handler(signal.SIGTERM, stop_event.set)
+        await stop_event.wait()
+
+        sun_task.cancel()
+        if motion_timeout_handle is not None:
+            motion_timeout_handle.cancel()
+            motion_timeout_handle = None
 
 
 try:
     asyncio.run(main())
 except KeyboardInterrupt:
+    # Ctrl-C during bridge setup, before main() installs its signal
+    # handlers.
     pass